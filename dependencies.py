@@ -1,20 +1,37 @@
 import os
+import pickle
+import time
+from contextlib import suppress
 from enum import Enum
 from functools import lru_cache, wraps
-from types import CoroutineType
-from typing import List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
+import aiohttp
 import asyncio
+import orjson
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi_cache import FastAPICache
+from fastapi_cache.coder import JsonCoder
 from fastapi_cache.decorator import cache
 from pydantic import AnyUrl, BaseModel
 from pydantic_settings import BaseSettings
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, ElementClickInterceptedException
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.remote.webelement import WebElement
+from redis.exceptions import RedisError
 
 INST_URL = "https://www.instagram.com"
+INST_API_URL = "https://i.instagram.com/api/v1"
+INST_LOGIN_URL = f"{INST_URL}/api/v1/web/accounts/login/ajax/"
+INST_PROFILE_INFO_URL = f"{INST_API_URL}/users/web_profile_info/"
+INST_USER_FEED_URL = f"{INST_API_URL}/feed/user/{{user_id}}/"
+INST_CURRENT_USER_URL = f"{INST_API_URL}/accounts/current_user/"
+INST_LOGIN_PATH = "/accounts/login"
+INST_APP_ID = "936619743392459"
+INST_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                   "(KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36")
+
+instagram_session: Optional[aiohttp.ClientSession] = None
+instagram_session_reset_at: Optional[float] = None
 
 
 class UserNotFound(Exception):
@@ -36,6 +53,16 @@ class UserNotFound(Exception):
         super().__init__(self.message, *args, **kwargs)
 
 
+class InstagramLoginFailed(Exception):
+    """Instagram login failed exception"""
+    message = "Instagram login failed"
+
+    def __init__(self, message: Optional[str] = None):
+        if message:
+            self.message = message
+        super().__init__(self.message)
+
+
 class AppSettings(BaseSettings):
     """App Settings"""
     DEBUG: bool = False
@@ -44,7 +71,11 @@ class AppSettings(BaseSettings):
     INST_PASSWORD: str
     REDIS_HOST: str
     REDIS_PORT: int
+    REDIS_MAX_CONNECTIONS: int = 50
     CORS_ORIGIN: str
+    INST_TIMEOUT: float = 10
+    INST_RELOGIN_INTERVAL: float = 300
+    INST_SESSION_PATH: str = os.path.join(os.path.expanduser("~"), ".glamapp", "instagram_session.pickle")
 
 
 class InstagramLinksModel(BaseModel):
@@ -52,62 +83,52 @@ class InstagramLinksModel(BaseModel):
     urls: List[Optional[AnyUrl]] = []
 
 
-class InstagramMediaTypesSelectors(Enum):
-    """
-    Instagram media types selectors
+class ORJsonCoder(JsonCoder):
+    """Cache coder serializing values with orjson"""
 
-    :returns: CSS selectors as value for needed media types
-    """
-    PHOTO = "//div[@role='button']//img[@style='object-fit: cover;']"
-    CLIP = "//div//video"
-    CAROUSEL = ""
+    @classmethod
+    def encode(cls, value: Any) -> bytes:
+        if isinstance(value, JSONResponse):
+            return value.body
+        return orjson.dumps(value, default=jsonable_encoder)
 
+    @classmethod
+    def decode(cls, value: Union[bytes, str]) -> Any:
+        return orjson.loads(value)
 
-class InstagramNextButtonSelectors(Enum):
+
+class InstagramMediaTypes(Enum):
     """
-    Instagram Next button selectors
+    Instagram media types
 
-    :returns: CSS selectors as value for needed element type
+    :returns: Instagram API media_type code as value
     """
-    POST = "svg[aria-label*='Next']"
-    SLIDE = "button[aria-label*='Next']"
+    PHOTO = 1
+    VIDEO = 2
+    ALBUM = 8
 
 
-def waiter_wrapper(top_attempts: int = 10,
-                   sleep_time: int = 1,
-                   exp_exc: Optional[list] = None):
+def coalesce(func):
     """
-    Tries to get result for top_attempts times
+    Shares one in-flight call between concurrent callers passing the same arguments
 
-    :param top_attempts: max count of tries
-    :param sleep_time: waiting time between attempts
-    :param exp_exc: error to be ignored
+    :param func: coroutine function
 
     :returns:
     """
-    exp_exc = exp_exc or []
+    inflight: Dict[tuple, asyncio.Task] = {}
 
-    def wrapper(func):
-        @wraps(func)
-        async def inner(*args, **kwargs):
-            attempts = 0
-            while True:
-                attempts += 1
-                try:
-                    result = func(*args, **kwargs)
-                    if isinstance(result, CoroutineType):
-                        result = await result
-                except Exception as e:
-                    if attempts >= top_attempts or type(e) in exp_exc:
-                        raise e
-                    await asyncio.sleep(sleep_time)
-                    continue
-                else:
-                    return result
+    @wraps(func)
+    async def inner(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        task = inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            inflight[key] = task
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+        return await asyncio.shield(task)
 
-        return inner
-
-    return wrapper
+    return inner
 
 
 @lru_cache
@@ -117,236 +138,315 @@ def get_config() -> AppSettings:
     return config
 
 
-async def create_driver() -> webdriver.Chrome:
-    """Creates Chrome driver"""
-    chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--window-size=1366,768")
-    prefs = {"profile.managed_default_content_settings.images": 2}
-    chrome_options.headless = True
-    chrome_options.add_experimental_option("prefs", prefs)
-    with webdriver.Chrome(service=Service(os.path.join(os.getcwd(), "chromedriver/chromedriver")),
-                          options=chrome_options) as chrome_driver:
-        yield chrome_driver
+async def login_instagram(session: aiohttp.ClientSession):
+    """
+    Login instagram, auth cookies are kept in session cookie jar
 
+    :param session: Instagram http session
 
-async def find_element(driver: Union[webdriver.Chrome, WebElement],
-                       by: By, value: str,
-                       tries: int = 10) -> Optional[WebElement]:
+    :raises InstagramLoginFailed: if Instagram did not authenticate the account
     """
-    Finds element by selector on active driver page
+    config = get_config()
+    async with session.get(url=INST_URL) as response:
+        response.raise_for_status()
+    csrf_token = session.cookie_jar.filter_cookies(INST_URL).get("csrftoken")
+    async with session.post(
+            url=INST_LOGIN_URL,
+            data={"username": config.INST_USERNAME,
+                  "enc_password": f"#PWD_INSTAGRAM_BROWSER:0:{int(time.time())}:{config.INST_PASSWORD}"},
+            headers={"X-CSRFToken": csrf_token.value if csrf_token else ""}) as response:
+        response.raise_for_status()
+        login = await read_instagram_json(response=response)
+    if not login.get("authenticated"):
+        raise InstagramLoginFailed(login.get("message"))
+
+
+@lru_cache
+def get_instagram_session_lock() -> asyncio.Lock:
+    """Gets lock guarding Instagram http session creation"""
+    return asyncio.Lock()
+
 
-    :param driver: driver
-    :param by: selector type
-    :param value: selector value
-    :param tries: number of tries
+def load_instagram_cookies(session: aiohttp.ClientSession,
+                           path: str):
+    """
+    Loads saved auth cookies, missing or corrupt file is treated as no cookies
 
-    :returns: Needed element if exists
+    :param session: Instagram http session
+    :param path: cookies file path
     """
-    element = None
     try:
-        element = await waiter_wrapper(top_attempts=tries)(driver.find_element)(by=by, value=value)
-    except NoSuchElementException:
+        session.cookie_jar.load(file_path=path)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
         pass
-    return element
 
 
-async def find_elements(driver: webdriver.Chrome,
-                        by: By,
-                        value: str) -> List[Optional[WebElement]]:
+def save_instagram_cookies(session: aiohttp.ClientSession,
+                           path: str):
+    """
+    Saves auth cookies through a temp file, so concurrent workers never read a half-written file
+
+    :param session: Instagram http session
+    :param path: cookies file path
     """
-    Finds elements by selector on active driver page
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    session.cookie_jar.save(file_path=tmp_path)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
 
-    :param driver: driver
-    :param by: selector type
-    :param value: selector value
 
-    :returns: Needed elements if exists
+async def read_instagram_json(response: aiohttp.ClientResponse) -> Dict[str, Any]:
     """
-    elements = []
-    try:
-        elements = await waiter_wrapper()(driver.find_elements)(by=by, value=value)
-    except NoSuchElementException:
-        pass
-    return elements
+    Reads Instagram response payload
+
+    :param response: Instagram response
+
+    :returns: JSON payload, empty for non JSON responses
+    """
+    return await response.json() if response.content_type == "application/json" else {}
+
+
+def is_login_required(response: aiohttp.ClientResponse,
+                      payload: Dict[str, Any]) -> bool:
+    """
+    Checks if Instagram revoked session auth
+
+    Bare 401/403 are not treated as revoked session, Instagram also answers them when rate limiting
+
+    :param response: Instagram response
+    :param payload: response payload
+
+    :returns: session has to log in again
+    """
+    return payload.get("message") == "login_required" or response.url.path.startswith(INST_LOGIN_PATH)
 
 
-async def get_url(driver: webdriver.Chrome,
-                  url: str):
+async def is_instagram_session_valid(session: aiohttp.ClientSession) -> bool:
     """
-    Opens passed url in current driver page
+    Checks restored auth cookies with one authenticated call
 
-    :param driver: driver
-    :param url: page url
+    :param session: Instagram http session
+
+    :returns: session is still logged in
     """
-    driver.get(url=url)
+    async with session.get(url=INST_CURRENT_USER_URL, params={"edit": "true"}) as response:
+        payload = await read_instagram_json(response=response)
+        return (response.status == status.HTTP_200_OK
+                and not is_login_required(response=response, payload=payload)
+                and bool(payload.get("user")))
 
 
-async def login_instagram(driver: webdriver.Chrome):
+async def get_instagram_session() -> aiohttp.ClientSession:
     """
-    Login instagram
+    Gets logged in Instagram http session shared between requests
+
+    Auth cookies are restored from INST_SESSION_PATH if still valid, otherwise session logs in and saves them
 
-    :param driver: driver
+    :raises InstagramLoginFailed: if Instagram did not authenticate the account
+
+    :returns: Instagram http session
+    """
+    global instagram_session
+    if instagram_session is None:
+        async with get_instagram_session_lock():
+            if instagram_session is None:
+                config = get_config()
+                session = aiohttp.ClientSession(headers={"X-IG-App-ID": INST_APP_ID,
+                                                         "User-Agent": INST_USER_AGENT},
+                                                timeout=aiohttp.ClientTimeout(total=config.INST_TIMEOUT))
+                try:
+                    load_instagram_cookies(session=session, path=config.INST_SESSION_PATH)
+                    if not (session.cookie_jar.filter_cookies(INST_URL).get("sessionid")
+                            and await is_instagram_session_valid(session=session)):
+                        session.cookie_jar.clear()
+                        await login_instagram(session=session)
+                        save_instagram_cookies(session=session, path=config.INST_SESSION_PATH)
+                except BaseException:
+                    await session.close()
+                    raise
+                instagram_session = session
+    return instagram_session
+
+
+async def reset_instagram_session(session: aiohttp.ClientSession) -> bool:
     """
-    await get_url(url=INST_URL, driver=driver)
+    Drops revoked Instagram http session, so the next call logs in again
+
+    Relogin happens at most once per INST_RELOGIN_INTERVAL, dropped session is closed after
+    INST_TIMEOUT, when its in-flight requests are finished
+
+    :param session: revoked Instagram http session
+
+    :returns: session was dropped
+    """
+    global instagram_session, instagram_session_reset_at
     config = get_config()
-    username_field = await find_element(driver=driver, by=By.CSS_SELECTOR,
-                                        value="input[name='username']")
-    password_field = await find_element(driver=driver, by=By.CSS_SELECTOR,
-                                        value="input[name='password']")
-    username_field.clear()
-    password_field.clear()
-    username_field.send_keys(config.INST_USERNAME)
-    password_field.send_keys(config.INST_PASSWORD)
-    submit_button = await find_element(driver=driver, by=By.CSS_SELECTOR,
-                                       value="button[type='submit']")
-    submit_button.click()
-    save_password = await find_element(driver=driver, by=By.XPATH,
-                                       value="//button[contains(text(), 'Not Now')]")
-    if save_password:
-        save_password.click()
-    notification_popup = await find_element(driver=driver, by=By.XPATH,
-                                            value="//button[contains(text(), 'Not Now')]")
-    if notification_popup:
-        notification_popup.click()
-
-
-async def validate_user(username: str,
-                        driver: webdriver.Chrome):
-    """
-    Validates user existence
+    async with get_instagram_session_lock():
+        if instagram_session is not session:
+            return True
+        now = time.monotonic()
+        if (instagram_session_reset_at is not None
+                and now - instagram_session_reset_at < config.INST_RELOGIN_INTERVAL):
+            return False
+        instagram_session_reset_at = now
+        instagram_session = None
+    asyncio.get_running_loop().call_later(config.INST_TIMEOUT, lambda: asyncio.ensure_future(session.close()))
+    return True
+
+
+async def close_instagram_session():
+    """Closes Instagram http session"""
+    global instagram_session
+    if instagram_session is not None:
+        await instagram_session.close()
+        instagram_session = None
+
+
+async def get_instagram_json(url: str,
+                             params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Gets Instagram API payload, logs in again and retries once if session was revoked
+
+    :param url: API url
+    :param params: query params
+
+    :raises InstagramLoginFailed: if session is still revoked and relogin is not allowed yet
+
+    :returns: response payload, None if resource not found
+    """
+    for _ in range(2):
+        session = await get_instagram_session()
+        async with session.get(url=url, params=params) as response:
+            if response.status == status.HTTP_404_NOT_FOUND:
+                return None
+            payload = await read_instagram_json(response=response)
+            if not is_login_required(response=response, payload=payload):
+                response.raise_for_status()
+                return payload
+        if not await reset_instagram_session(session=session):
+            break
+    raise InstagramLoginFailed("Instagram session revoked")
+
+
+def get_instagram_user_id_cache_key(username: str) -> str:
+    """
+    Gets cache key of Instagram user id
 
     :param username: Instagram username
-    :param driver: driver
 
-    :raises UserNotFound: if user page not exists 
+    :returns: cache key
     """
-    try:
-        await login_instagram(driver=driver)
-    except NoSuchElementException:
-        pass
-    await get_url(url=f"{INST_URL}/{username}", driver=driver)
-    posts_tab = await find_element(driver=driver, by=By.XPATH, value="//span[contains(text(), 'Posts')]")
-    if posts_tab is None:
-        raise UserNotFound(username=username)
+    return f"{FastAPICache.get_prefix()}:instagram-user-id:{username}"
+
+
+def instagram_user_id_key_builder(func: Callable,
+                                  namespace: Optional[str] = "",
+                                  request: Optional[Request] = None,
+                                  response: Optional[Response] = None,
+                                  args: Optional[tuple] = None,
+                                  kwargs: Optional[dict] = None) -> str:
+    """Builds readable user id cache key, so the entry can be evicted by username"""
+    username = (kwargs or {}).get("username") or args[0]
+    return get_instagram_user_id_cache_key(username=username)
 
 
-async def get_profile(username: str,
-                      driver: webdriver.Chrome):
+async def evict_instagram_user_id(username: str):
     """
-    Opens passed url in current driver page
+    Evicts cached Instagram user id, cache errors are ignored like in fastapi_cache itself
 
-    :param driver: driver
     :param username: Instagram username
     """
-    await validate_user(username=username, driver=driver)
-    await get_url(url=f"{INST_URL}/{username}", driver=driver)
+    with suppress(RedisError):
+        await FastAPICache.get_backend().clear(key=get_instagram_user_id_cache_key(username=username))
 
 
-@cache(15)
-async def get_post_type(driver: webdriver.Chrome) -> InstagramMediaTypesSelectors:
+@cache(expire=600, key_builder=instagram_user_id_key_builder)
+async def get_instagram_user_id(username: str) -> str:
     """
-    Gets post content type
+    Gets Instagram user id
 
-    :param driver: driver
+    :param username: Instagram username
+
+    :raises UserNotFound: if user not exists
 
-    :returns: post media type
+    :returns: user id
     """
-    if "?img_index" in driver.current_url:
-        post_type = InstagramMediaTypesSelectors.CAROUSEL
-    else:
-        post_type = InstagramMediaTypesSelectors.PHOTO if await find_element(
-            driver=driver, by=By.XPATH,
-            value=InstagramMediaTypesSelectors.PHOTO.value) else InstagramMediaTypesSelectors.CLIP
-    return post_type
+    profile = await get_instagram_json(url=INST_PROFILE_INFO_URL, params={"username": username})
+    user = ((profile or {}).get("data") or {}).get("user")
+    if not user:
+        raise UserNotFound(username=username)
+    return user["id"]
 
 
-async def next_element(driver: webdriver.Chrome,
-                       button_selector: InstagramNextButtonSelectors,
-                       tries: int = 1) -> bool:
+def get_photo_url(media: Dict[str, Any]) -> Optional[str]:
     """
-    Switches to next element if button exists
+    Gets post photo url, the first photo is taken for albums
 
-    :param driver: driver
-    :param button_selector: Next button selector
-    :param tries: max tries
+    :param media: Instagram post
 
-    :returns: is last element
+    :returns: photo url if post contains photo
     """
-    end = True
-    for _ in range(tries):
-        next_button = await find_element(driver=driver, by=By.CSS_SELECTOR,
-                                         value=button_selector.value)
-        if next_button:
-            try:
-                next_button.click()
-            except ElementClickInterceptedException:
-                driver.execute_script("arguments[0].click();", next_button)
-            end = False
-            break
-    return end
+    photo = None
+    if media["media_type"] == InstagramMediaTypes.PHOTO.value:
+        photo = media
+    elif media["media_type"] == InstagramMediaTypes.ALBUM.value:
+        photo = next((resource for resource in media.get("carousel_media", [])
+                      if resource["media_type"] == InstagramMediaTypes.PHOTO.value), None)
+    return photo["image_versions2"]["candidates"][0]["url"] if photo else None
 
 
-async def get_carousel_media(driver: webdriver.Chrome,
-                             media_type: InstagramMediaTypesSelectors,
-                             max_count: int = 1) -> InstagramLinksModel:
+async def get_instagram_posts(user_id: str,
+                              max_count: int) -> List[Dict[str, Any]]:
     """
-    Gets carousel media urls
+    Gets Instagram user posts page by page until max_count photos are collected
 
-    :param driver: driver
-    :param max_count: posts max count
-    :param media_type: expected media type
+    :param user_id: Instagram user id
+    :param max_count: photos max count
 
-    :returns:
+    :raises UserNotFound: if user feed not exists
+
+    :returns: list of posts
     """
-    carousel_media_links = []
-    last_slide = False
-    while not last_slide and len(carousel_media_links) < max_count:
-        carousel_element = await find_element(
-            driver=driver, by=By.XPATH,
-            value=f"//div[@role='presentation']/"
-                  f"/ul/li[contains(@tabindex, '1')][last(){-1 if not last_slide else ''}]")
-        slide_media = await find_element(driver=carousel_element, by=By.XPATH, value=media_type.value)
-        if slide_media:
-            carousel_media_links.append(slide_media.get_attribute("src"))
-        last_slide = await next_element(
-            driver=driver, button_selector=InstagramNextButtonSelectors.SLIDE, tries=3)
-    return InstagramLinksModel(urls=carousel_media_links)
+    posts = []
+    photos_count = 0
+    params = {"count": max_count}
+    while photos_count < max_count:
+        page = await get_instagram_json(url=INST_USER_FEED_URL.format(user_id=user_id), params=params)
+        if page is None:
+            raise UserNotFound(user_id=user_id)
+        items = page.get("items", [])
+        posts.extend(items)
+        photos_count += sum(1 for post in items if get_photo_url(media=post))
+        next_max_id = page.get("next_max_id")
+        if not items or not page.get("more_available") or not next_max_id:
+            break
+        params["max_id"] = next_max_id
+    return posts
 
 
 @cache(expire=15)
-async def get_profile_media_urls(username: str,
-                                 media_type: InstagramMediaTypesSelectors,
-                                 driver: webdriver.Chrome,
-                                 max_count: Optional[int] = None) -> InstagramLinksModel:
+@coalesce
+async def get_instagram_user_photos(username: str,
+                                    max_count: int) -> InstagramLinksModel:
     """
-    Gets Instagram media urls
+    Gets Instagram user photos urls
 
-    :param driver: driver
     :param username: Instagram username
-    :param max_count: posts max count
-    :param media_type: expected media type
+    :param max_count: photos max count
 
-    :returns: list of media urls
+    :returns: list of photos urls
     """
     medias = []
-    await get_profile(username=username, driver=driver)
+    user_id = await get_instagram_user_id(username=username)
     if max_count != 0:
-        latest_post = await find_element(driver=driver, by=By.CSS_SELECTOR, value="a[href*='/p/']")
-        if latest_post:
-            latest_post.click()
-            last_post = False
-            while len(medias) < max_count and not last_post:
-                post_type = await get_post_type(driver=driver)
-                if post_type == media_type:
-                    medias.append((await find_element(driver=driver, by=By.XPATH,
-                                                      value=media_type.value)).get_attribute("src"))
-                if post_type == InstagramMediaTypesSelectors.CAROUSEL:
-                    carousel_media = await get_carousel_media(driver=driver, media_type=media_type, max_count=1)
-                    if carousel_media.urls:
-                        medias.append(carousel_media.urls[0])
-                last_post = await next_element(driver=driver, button_selector=InstagramNextButtonSelectors.POST)
-
-    return InstagramLinksModel(urls=medias)
+        try:
+            posts = await get_instagram_posts(user_id=user_id, max_count=max_count)
+        except UserNotFound:
+            await evict_instagram_user_id(username=username)
+            raise UserNotFound(username=username)
+        for post in posts:
+            photo_url = get_photo_url(media=post)
+            if photo_url:
+                medias.append(photo_url)
+    return InstagramLinksModel(urls=medias[:max_count])
@@ -1,3 +1,7 @@
+import logging
+
+import aiohttp
+import asyncio
 from fastapi import FastAPI, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
@@ -5,11 +9,13 @@ from redis import asyncio as aioredis
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 from starlette.middleware.cors import CORSMiddleware
-from webdriver_manager.chrome import ChromeDriverManager
 
-from dependencies import get_config, UserNotFound, waiter_wrapper
+from dependencies import (get_config, close_instagram_session, get_instagram_session,
+                          InstagramLoginFailed, ORJsonCoder, UserNotFound)
 from routers import instagram
 
+logger = logging.getLogger(__name__)
+
 config = get_config()
 
 app = FastAPI()
@@ -31,6 +37,12 @@ def inst_user_not_found_handler(request: Request, exc: UserNotFound):
                         content=jsonable_encoder({"detail": exc.message}))
 
 
+@app.exception_handler(InstagramLoginFailed)
+def inst_login_failed_handler(request: Request, exc: InstagramLoginFailed):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content=jsonable_encoder({"detail": exc.message}))
+
+
 @app.on_event("startup")
 async def startup_event():
     environment = config.ENVIRONMENT
@@ -38,9 +50,20 @@ async def startup_event():
     show_docs_environments = ("local", "staging")
     redis_host = config.REDIS_HOST
     redis_port = config.REDIS_PORT
+    redis_max_connections = config.REDIS_MAX_CONNECTIONS
     if environment not in show_docs_environments:
         app.openapi_url = None
     app.title = "GlamAI Test Task"
     app.debug = debug
-    redis = aioredis.from_url(url=f"redis://{redis_host}:{redis_port}", encoding="utf8", decode_responses=True)
-    FastAPICache.init(backend=RedisBackend(redis=redis), prefix="fastapi-cache")
+    redis = aioredis.from_url(url=f"redis://{redis_host}:{redis_port}", encoding="utf8", decode_responses=True,
+                              max_connections=redis_max_connections)
+    FastAPICache.init(backend=RedisBackend(redis=redis), prefix="fastapi-cache", coder=ORJsonCoder)
+    try:
+        await get_instagram_session()
+    except (aiohttp.ClientError, asyncio.TimeoutError, InstagramLoginFailed):
+        logger.exception("Instagram login failed, retrying on first request")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_instagram_session()